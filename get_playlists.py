@@ -25,6 +25,7 @@ class RawTrack:
     image_url: str
     track_number: int
     disc_number: int
+    duration_ms: int
     musicbrainz_id: str
 
 
@@ -51,6 +52,7 @@ def get_tracks_in_list(input_tracks: list):
             image_url=_track["track"]["album"]["images"][0]["url"] if len(_track["track"]["album"]["images"]) > 0 else "",
             track_number=_track["track"]["track_number"],
             disc_number=_track["track"]["disc_number"],
+            duration_ms=_track["track"]["duration_ms"],
             musicbrainz_id=""
         ))
     return tracks
@@ -175,7 +177,8 @@ def get_everything_in_library(spot):
                     "album": track.album,
                     "image_url": track.image_url,
                     "track_number": track.track_number,
-                    "disc_number": track.disc_number
+                    "disc_number": track.disc_number,
+                    "duration_ms": track.duration_ms
                 }
             )
 
@@ -207,7 +210,8 @@ def get_single_album(spot, album_id):
                 "album": track.album,
                 "image_url": track.image_url,
                 "track_number": track.track_number,
-                "disc_number": track.disc_number
+                "disc_number": track.disc_number,
+                "duration_ms": track.duration_ms
             }
         )
 
@@ -249,7 +253,8 @@ def get_every_album_of_everything_in_library(spot):
                     "album": track.album,
                     "image_url": track.image_url,
                     "track_number": track.track_number,
-                    "disc_number": track.disc_number
+                    "disc_number": track.disc_number,
+                    "duration_ms": track.duration_ms
                 }
             )
 
@@ -289,7 +294,8 @@ def get_every_album_of_everything_in_library(spot):
                             "album": subtrack["album"],
                             "image_url": subtrack["image_url"],
                             "track_number": subtrack["track_number"],
-                            "disc_number": subtrack["disc_number"]
+                            "disc_number": subtrack["disc_number"],
+                            "duration_ms": subtrack["duration_ms"]
                         }
                     )
                 outlist.append(
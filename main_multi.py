@@ -6,8 +6,9 @@ from librespot.core import Session
 
 from pydub import AudioSegment
 
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3, APIC
+from mutagen.id3 import ID3, APIC, TXXX
 
 from colorama import Fore, Back, Style
 
@@ -18,11 +19,27 @@ from math import ceil, floor
 from enum import Enum
 import traceback
 import datetime
+import shutil
 import json
 import os
 
 TMP_DIR = os.path.join(os.getcwd(), "tmp")
 
+# ID3 TXXX description used to remember which quality tier a file was made with
+QUALITY_TAG = "SPOTIFY_DL_QUALITY"
+# Used for tracks from older spotify-playlists.json files that have no duration yet
+DEFAULT_DURATION_MS = 210_000
+# Bytes per second assumed for a stream until the first one has been measured
+ASSUMED_THROUGHPUT = 500_000
+# Seconds per track spent outside the stream read (audio key, rate limit waits, converting, cover),
+# assumed until the first track has been measured
+ASSUMED_TRACK_OVERHEAD = 10
+# Bytes per mp3 on top of the audio itself (embedded cover, tags, share of folder.png)
+FILE_OVERHEAD_BYTES = 400_000
+# Free space that is never planned for (tmp files, .mp3.part files next to the ones they replace)
+DISK_RESERVE_BYTES = 500_000_000
+DISK_RESERVE_RATIO = 0.05
+
 
 @dataclass
 class Playlist:
@@ -42,12 +59,31 @@ class Track:
     image_url: list[str]
     track_number: int
     disc_number: int
+    duration_ms: int
 
 
 @dataclass
 class DownloadArgs:
     """This seems useless, but it makes passing args into the pool easier"""
     data: list[tuple[Track, str, str, int, int]]
+    levels: list[int]
+
+
+@dataclass
+class QualityTier:
+    name: str
+    audio_quality: AudioQuality
+    stream_kbps: int
+    mp3_kbps: int
+
+
+# Best first. The index into this list is the "level" used everywhere below.
+QUALITY_TIERS = [
+    QualityTier("VERY_HIGH", AudioQuality.VERY_HIGH, 320, 320),
+    QualityTier("HIGH", AudioQuality.HIGH, 160, 192),
+    QualityTier("NORMAL", AudioQuality.NORMAL, 96, 128),
+]
+LOWEST_LEVEL = len(QUALITY_TIERS) - 1
 
 
 class DownloadState(Enum):
@@ -70,6 +106,95 @@ def compatible(text):
             .replace("|", ";").replace("?", "!").replace("*", "#"))[:120]
 
 
+def estimate_bytes(duration_ms: int, kbps: int) -> int:
+    return ceil(duration_ms / 1000 * kbps * 1000 / 8)
+
+
+def estimate_file_bytes(duration_ms: int, level: int) -> int:
+    return estimate_bytes(duration_ms, QUALITY_TIERS[level].mp3_kbps) + FILE_OVERHEAD_BYTES
+
+
+def plan_disk_levels(durations: list[int], budget_bytes: int) -> list[int]:
+    """Lowest level (= best quality) per track so that all mp3s together fit into budget_bytes.
+    Tracks at the end of the list get downgraded first, one tier per pass."""
+    levels = [0 for _ in durations]
+    total = sum(estimate_file_bytes(duration, 0) for duration in durations)
+
+    while total > budget_bytes:
+        changed = False
+        for i in reversed(range(len(durations))):
+            if total <= budget_bytes:
+                break
+            if levels[i] == LOWEST_LEVEL:
+                continue
+            total -= estimate_file_bytes(durations[i], levels[i])
+            levels[i] += 1
+            total += estimate_file_bytes(durations[i], levels[i])
+            changed = True
+        if not changed:
+            break
+
+    return levels
+
+
+def recorded_quality_level(mp3_path: str) -> int:
+    """Level a finished mp3 was made with. Files without a (readable) tag are from before tiers existed, so 320k."""
+    try:
+        frame = ID3(mp3_path).get(f"TXXX:{QUALITY_TAG}")
+    except MutagenError:
+        return 0
+    if frame is None or len(frame.text) == 0:
+        return 0
+    for level, tier in enumerate(QUALITY_TIERS):
+        if tier.name == frame.text[0]:
+            return level
+    return 0
+
+
+class QualityPlanner:
+    """Picks the quality of each track of one process from its disk level and the time that is left.
+    Every process has its own planner, so the throughput is measured per stream."""
+    def __init__(self, deadline: float | None, durations: list[int], levels: list[int]):
+        self.deadline = deadline
+        self.levels = levels
+        self.throughput = ASSUMED_THROUGHPUT
+        self.track_overhead = ASSUMED_TRACK_OVERHEAD
+        self.measured = False
+
+        # remaining[level][i] = stream bytes of tracks i.. if all of them use at most this level
+        self.remaining = []
+        for level in range(len(QUALITY_TIERS)):
+            suffix = [0 for _ in range(len(durations) + 1)]
+            for i in reversed(range(len(durations))):
+                kbps = QUALITY_TIERS[max(level, levels[i])].stream_kbps
+                suffix[i] = suffix[i + 1] + estimate_bytes(durations[i], kbps)
+            self.remaining.append(suffix)
+
+    def pick(self, index: int) -> QualityTier:
+        if self.deadline is None:
+            return QUALITY_TIERS[self.levels[index]]
+
+        seconds_left = self.deadline - datetime.datetime.now().timestamp()
+        overhead = (len(self.levels) - index) * self.track_overhead
+        for level in range(self.levels[index], LOWEST_LEVEL + 1):
+            if self.remaining[level][index] / self.throughput + overhead <= seconds_left:
+                return QUALITY_TIERS[level]
+        return QUALITY_TIERS[LOWEST_LEVEL]
+
+    def record(self, size: int, read_seconds: float, track_seconds: float):
+        """read_seconds is the time spent reading the stream, track_seconds the time for the whole track."""
+        if read_seconds <= 0:
+            return
+        overhead = max(track_seconds - read_seconds, 0)
+        if not self.measured:
+            self.throughput = size / read_seconds
+            self.track_overhead = overhead
+            self.measured = True
+        else:
+            self.throughput = 0.7 * self.throughput + 0.3 * size / read_seconds
+            self.track_overhead = 0.7 * self.track_overhead + 0.3 * overhead
+
+
 def console_log_file(action: LogAction, playlist_name: str, playlist_index: int, playlist_size: int, filename: str):
     style = Style.RESET_ALL
     match action:
@@ -126,7 +251,10 @@ def console_log_info(text: str):
     print(f"{style}{text}")
 
 
-def download(output_path: str, processes: int):
+def download(output_path: str, processes: int, max_hours: float | None = None, max_gb: float | None = None,
+             upgrade: bool = False):
+    deadline = None if max_hours is None else datetime.datetime.now().timestamp() + max_hours * 3600
+
     with open("spotify-playlists.json", "r") as f:
         playlists = json.loads(f.read())
 
@@ -135,6 +263,7 @@ def download(output_path: str, processes: int):
 
     download_args = []
     total_songs = 0
+    replaced_bytes = 0
 
     # Collect all tracks
     for _playlist in playlists:
@@ -164,7 +293,8 @@ def download(output_path: str, processes: int):
                 added=added_time,
                 image_url=_track["image_url"],
                 track_number=_track["track_number"],
-                disc_number=_track["disc_number"]
+                disc_number=_track["disc_number"],
+                duration_ms=_track.get("duration_ms", DEFAULT_DURATION_MS)
             )
 
             filename = f"{compatible(track.name)} - {compatible(', '.join(track.artists if len(track.artists) < 3 else track.artists[:2]))}"
@@ -175,13 +305,32 @@ def download(output_path: str, processes: int):
 
             if os.path.exists(mp3_path):
                 if os.path.getsize(mp3_path) > 0:
-                    console_log_file(LogAction.SKIP, playlist.name, i, playlist.size, filename)
-                    continue
+                    if not upgrade or recorded_quality_level(mp3_path) == 0:
+                        console_log_file(LogAction.SKIP, playlist.name, i, playlist.size, filename)
+                        continue
+                    # The new file replaces this one, so its space counts towards the budget
+                    replaced_bytes += os.path.getsize(mp3_path)
 
             download_args.append((track, playlist.directory, playlist.name, playlist.size, i))
 
     console_log_info(f"Downloading {len(download_args)}/{total_songs} total tracks.")
 
+    # Pick the best quality per track that fits into the free space (and max_gb if given)
+    free_bytes = shutil.disk_usage(output_path).free
+    free_bytes -= max(DISK_RESERVE_BYTES, ceil(free_bytes * DISK_RESERVE_RATIO))
+    budget_bytes = max(free_bytes, 0) + replaced_bytes
+    if max_gb is not None:
+        budget_bytes = min(budget_bytes, ceil(max_gb * 1e9) + replaced_bytes)
+    durations = [args[0].duration_ms for args in download_args]
+    levels = plan_disk_levels(durations, budget_bytes)
+
+    planned_bytes = sum(estimate_file_bytes(d, l) for d, l in zip(durations, levels))
+    downgraded = sum(1 for level in levels if level > 0)
+    console_log_info(f"Estimated size: {round(planned_bytes / 1e9, 2)} GB "
+                     f"(budget {round(budget_bytes / 1e9, 2)} GB, {downgraded} tracks downgraded).")
+    if planned_bytes > budget_bytes:
+        console_log_info("Even the lowest quality does not fit into the budget!")
+
     # Shared list for progress
     # Contains 4 elements per process. That's why PROCESSES*4 here and also chunk*4 below.
     # The last element has a timestamp of the last time full progress was shown.
@@ -195,7 +344,10 @@ def download(output_path: str, processes: int):
         end_pos = start_pos + chunk_size
         if chunk == PROCESSES - 1:  # On last chunk just take all the rest
             end_pos = len(download_args)
-        process_args.append((DownloadArgs(data=download_args[start_pos:end_pos]), chunk*4, shared_list))
+        process_args.append((
+            DownloadArgs(data=download_args[start_pos:end_pos], levels=levels[start_pos:end_pos]),
+            chunk*4, shared_list, deadline
+        ))
 
     for file in os.listdir(TMP_DIR):
         os.remove(os.path.join(TMP_DIR, file))
@@ -205,21 +357,23 @@ def download(output_path: str, processes: int):
         console_log_info("Done!")
 
 
-def run_download_process(download_args: DownloadArgs, process_id: int, sl: shared_memory.ShareableList):
+def run_download_process(download_args: DownloadArgs, process_id: int, sl: shared_memory.ShareableList,
+                         deadline: float | None):
     session = Session.Builder().stored_file().create()
     sl[process_id] = len(download_args.data)
+    planner = QualityPlanner(deadline, [args[0].duration_ms for args in download_args.data], download_args.levels)
 
     console_log_info(f"Process {round(process_id/4)+1} created.")
 
     for i, args in enumerate(download_args.data):
-        download_state = download_song(session, *args)
+        download_state = download_song(session, *args, planner.pick(i), planner)
         sl[process_id + download_state.value] += 1
 
         console_log_progress(download_state, process_id, sl)
 
 
 def download_song(session: Session, track: Track, directory: os.path, playlist_name: str, playlist_size: int,
-                  playlist_index: int) -> DownloadState:
+                  playlist_index: int, tier: QualityTier, planner: QualityPlanner) -> DownloadState:
     filename = f"{compatible(track.name)} - {compatible(', '.join(track.artists if len(track.artists) < 3 else track.artists[:2]))}"
     path = os.path.join(directory, filename)
     error_path = f"{path}.error"
@@ -231,13 +385,14 @@ def download_song(session: Session, track: Track, directory: os.path, playlist_n
     if os.path.exists(error_path):
         os.remove(error_path)
 
-    # Check here again just to be safe
+    # Check here again just to be safe. Only replace existing files with a better quality.
     if os.path.exists(mp3_path):
-        if os.path.getsize(mp3_path) > 0:
+        if os.path.getsize(mp3_path) > 0 and recorded_quality_level(mp3_path) <= QUALITY_TIERS.index(tier):
             console_log_file(LogAction.SKIP, *log_args)
             return DownloadState.SKIP
 
-    stream_result, stream_data = get_stream(session, track, log_args)
+    track_start = time.monotonic()
+    stream_result, stream_data = get_stream(session, track, tier, log_args)
     if not stream_result:
         console_log_file(LogAction.ERROR, *log_args)
         with open(error_path, "w") as f:
@@ -247,21 +402,24 @@ def download_song(session: Session, track: Track, directory: os.path, playlist_n
 
     console_log_file(LogAction.DOWNLOAD, *log_args)
 
+    read_start = time.monotonic()
     stream_size = stream_data.input_stream.stream().size()
     with open(tmp_path, "wb") as f:
         f.write(stream_data.input_stream.stream().read(stream_size))
+    read_seconds = time.monotonic() - read_start
 
-    convert_song(track, directory, playlist_name, playlist_size, playlist_index)
+    convert_song(track, directory, playlist_name, playlist_size, playlist_index, tier)
+    planner.record(stream_size, read_seconds, time.monotonic() - track_start)
     return DownloadState.SUCCESS
 
 
-def get_stream(session: Session, track: Track, log_args: tuple) -> tuple[bool, str] | tuple[bool, ...]:
+def get_stream(session: Session, track: Track, tier: QualityTier, log_args: tuple) -> tuple[bool, str] | tuple[bool, ...]:
     stream = None
     sleep_time = 5
     while stream is None:
         try:
             stream = session.content_feeder().load(
-                track.id, VorbisOnlyAudioQuality(AudioQuality.VERY_HIGH), False, None
+                track.id, VorbisOnlyAudioQuality(tier.audio_quality), False, None
             )
         except (ValueError, OSError):
             pass
@@ -277,7 +435,8 @@ def get_stream(session: Session, track: Track, log_args: tuple) -> tuple[bool, s
     return True, stream
 
 
-def convert_song(track: Track, directory: os.path, playlist_name, playlist_size, playlist_index, *args):
+def convert_song(track: Track, directory: os.path, playlist_name, playlist_size, playlist_index, tier: QualityTier,
+                 *args):
     filename = f"{compatible(track.name)} - {compatible(', '.join(track.artists if len(track.artists) < 3 else track.artists[:2]))}"
     path = os.path.join(directory, filename)
     tmp_path = os.path.join(TMP_DIR, f"{filename}.ogg.tmp")
@@ -286,7 +445,7 @@ def convert_song(track: Track, directory: os.path, playlist_name, playlist_size,
 
     console_log_file(LogAction.CONVERT, playlist_name, playlist_index, playlist_size, filename)
 
-    AudioSegment.from_file(tmp_path, format="ogg").export(tmp_mp3_path, format="mp3", bitrate="320k")
+    AudioSegment.from_file(tmp_path, format="ogg").export(tmp_mp3_path, format="mp3", bitrate=f"{tier.mp3_kbps}k")
     os.remove(tmp_path)
 
     audio = EasyID3(tmp_mp3_path)
@@ -307,6 +466,7 @@ def convert_song(track: Track, directory: os.path, playlist_name, playlist_size,
         type=3, desc=u'Cover',
         data=image_data
     )
+    audio[f'TXXX:{QUALITY_TAG}'] = TXXX(encoding=3, desc=QUALITY_TAG, text=tier.name)
     audio.save()
 
     # THIS IS ONLY FOR ALBUMS - PLEASE COMMENT OUT.
@@ -315,7 +475,7 @@ def convert_song(track: Track, directory: os.path, playlist_name, playlist_size,
         with open(folder_path, "wb") as img_file:
             img_file.write(image_data)
 
-    os.rename(tmp_mp3_path, mp3_path)
+    os.replace(tmp_mp3_path, mp3_path)
     os.utime(mp3_path, (track.added.timestamp(), track.added.timestamp()))
 
 
@@ -334,10 +494,17 @@ if __name__ == "__main__":
     PROCESSES = 1
     console_log_info(f"Running {PROCESSES} sessions.")
 
+    # Lower the quality if needed to finish within MAX_HOURS or to stay under MAX_GB. None means no limit.
+    MAX_HOURS = None
+    MAX_GB = None
+    # Download tracks again that were downgraded by an earlier run
+    UPGRADE_DOWNGRADED = False
+
     console_log_info(f"Clearing old temp files...")
     if not os.path.exists(TMP_DIR):
         os.mkdir(TMP_DIR)
 
-    download(output_path="/etc/jellyfin/media/SpotifyDL", processes=PROCESSES)
+    download(output_path="/etc/jellyfin/media/SpotifyDL", processes=PROCESSES,
+             max_hours=MAX_HOURS, max_gb=MAX_GB, upgrade=UPGRADE_DOWNGRADED)
 
     # /etc/jellyfin/media/SpotifyDL